@@ -1,24 +1,46 @@
 import streamlit as st
 import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.util.request import ACCEPT_ENCODING
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import folium
 from streamlit_folium import st_folium
-from shapely.geometry import Point
 import plotly.express as px
 import plotly.graph_objects as go
 import plotly.io as pio
 from io import BytesIO
+from PIL import Image, ImageDraw, ImageFilter
 import base64
-import streamlit.components.v1 as components
-import json
+try:
+    # Codificador base64 vectorizado (SIMD); sin la rueda se usa el módulo estándar con la misma interfaz
+    from pybase64 import b64encode_as_string
+except ImportError:
+    def b64encode_as_string(datos):
+        return base64.b64encode(datos).decode("ascii")
+import pyogrio
+import jinja2
 import pydeck as pdk
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
 
 import os
+import math
+import hashlib
+import tempfile
+import zipfile
+import time
+from pathlib import Path
+from urllib.parse import quote
 
 
 
 if os.environ.get("STREAMLIT_RUNNING") == "true":
-    import plotly.io as pio
     pio.kaleido.scope.chromium_args = (
         "--headless",
         "--no-sandbox",
@@ -33,61 +55,562 @@ if os.environ.get("STREAMLIT_RUNNING") == "true":
 st.set_page_config(page_title="AVM Bogotá APP", page_icon="🏠", layout="centered")
 st.title("🏠 AVM Bogotá - Análisis de Manzanas")
 
-# --- Función cacheada para la carga de datos (con manejo de errores y reintentos) ---
-@st.cache_data
-def cargar_datasets():
-    datasets = {
-        "localidades": "https://github.com/andres-fuentex/tfm-avm-bogota/raw/main/datos_visualizacion/datos_geograficos_geo/dim_localidad.geojson",
-        "areas": "https://github.com/andres-fuentex/tfm-avm-bogota/raw/main/datos_visualizacion/datos_geograficos_geo/dim_area.geojson",
-        "manzanas": "https://github.com/andres-fuentex/tfm-avm-bogota/raw/main/datos_visualizacion/datos_geograficos_geo/tabla_hechos.geojson",
-        "transporte": "https://github.com/andres-fuentex/tfm-avm-bogota/raw/main/datos_visualizacion/datos_geograficos_geo/dim_transporte.geojson",
-        "colegios": "https://github.com/andres-fuentex/tfm-avm-bogota/raw/main/datos_visualizacion/datos_geograficos_geo/dim_colegios.geojson"
-    }
-
+# --- Columnas que usa la aplicación por dataset; el resto se descarta al cargar ---
+COLUMNAS_USADAS = {
+    "localidades": ["nombre_localidad", "num_localidad", "cantidad_delitos", "nivel_riesgo_delictivo", "geometry"],
+    # De las áreas POT solo se usan atributos (uso y nombre del área): sus polígonos no se leen
+    "areas": ["id_area", "num_localidad", "uso_pot_simplificado", "area_pot"],
+    "manzanas": [
+        "id_manzana_unif", "num_localidad", "id_area", "id_combi_acceso", "id_com_colegios",
+        "valor_m2", "valor_2025_s1", "valor_2025_s2", "valor_2026_s1", "valor_2026_s2",
+        "estrato", "rentabilidad", "colegio_cerca", "estaciones_cerca", "geometry"
+    ],
+    "transporte": ["id_combi_acceso", "geometry"],
+    "colegios": ["id_com_colegios", "geometry"],
+}
+
+def recortar_columnas(gdf, nombre):
+    return gdf[[c for c in COLUMNAS_USADAS[nombre] if c in gdf.columns]]
+
+# --- Reducción de tipos tras la carga: ids a int32 (id_area al entero más pequeño posible) y usos POT como categoría ---
+def optimizar_tipos(df):
+    if "num_localidad" in df.columns:
+        df["num_localidad"] = df["num_localidad"].astype("int32")
+    if "id_area" in df.columns:
+        df["id_area"] = pd.to_numeric(df["id_area"], downcast="integer")
+    if "uso_pot_simplificado" in df.columns:
+        df["uso_pot_simplificado"] = df["uso_pot_simplificado"].astype("category")
+    return df
+
+# --- Mapa de colores por uso POT (orden determinista para que no cambie entre reruns) ---
+# Las categorías del dtype categórico ya vienen ordenadas: no hace falta unique() + sorted() sobre las filas.
+def construir_color_map(areas):
+    palette = np.array(px.colors.qualitative.Plotly)
+    usos = areas["uso_pot_simplificado"].astype("category").cat.remove_unused_categories().cat.categories
+    color_map = dict(zip(usos, palette[np.arange(len(usos)) % len(palette)].tolist()))
+    if "Sin clasificación" not in color_map:
+        color_map["Sin clasificación"] = "#2b2b2b"
+    return color_map
+
+# --- Caché en disco: GeoParquet ya procesado + ETag de la última descarga, por URL ---
+# Vive en el directorio temporal del sistema (escribible también en contenedores con el repo de solo lectura);
+# la clave es el sha1 de la URL, las columnas guardadas y CACHE_VERSION: cambiar una URL o COLUMNAS_USADAS no
+# reutiliza un fichero de otra fuente o esquema. Subir CACHE_VERSION al modificar optimizar_tipos.
+CACHE_DIR = Path(tempfile.gettempdir()) / "avm_cache"
+CACHE_VERSION = 1
+# Un parquet más reciente que esto se usa sin tocar la red; pasado ese tiempo se revalida con el ETag
+CACHE_VIGENCIA_S = 6 * 3600
+
+# --- Descarga y lectura de un dataset GeoJSON (se ejecuta en un hilo del pool) ---
+def descargar_dataset(session, nombre, url):
+    clave = hashlib.sha1(f"{CACHE_VERSION}|{url}|{','.join(COLUMNAS_USADAS[nombre])}".encode()).hexdigest()
+    ruta_parquet = CACHE_DIR / f"{clave}.parquet"
+    ruta_etag = CACHE_DIR / f"{clave}.etag"
+
+    # Datasets sin "geometry" en COLUMNAS_USADAS se cargan como DataFrame de atributos, sin parsear polígonos
+    con_geometria = "geometry" in COLUMNAS_USADAS[nombre]
+    leer_parquet = gpd.read_parquet if con_geometria else pd.read_parquet
+
+    # Parquet local ilegible (escritura a medias de una versión anterior, disco dañado...): se borra junto a su
+    # ETag para que la descarga siguiente sea completa, sin If-None-Match que devuelva 304 sobre el mismo fichero.
+    def leer_cache():
+        try:
+            return recortar_columnas(leer_parquet(ruta_parquet), nombre)
+        except Exception:
+            try:
+                ruta_parquet.unlink(missing_ok=True)
+                ruta_etag.unlink(missing_ok=True)
+            except OSError:
+                pass
+            return None
+
+    # Caché vigente: arranque en frío sin ida y vuelta a GitHub
+    if ruta_parquet.exists() and time.time() - ruta_parquet.stat().st_mtime < CACHE_VIGENCIA_S:
+        gdf = leer_cache()
+        if gdf is not None:
+            return gdf
+
+    # GET condicional: si el fichero no cambió, el servidor responde 304 y se lee el parquet local
+    headers = {}
+    if ruta_parquet.exists() and ruta_etag.exists():
+        headers["If-None-Match"] = ruta_etag.read_text()
+
+    response = session.get(url, timeout=30, headers=headers)
+    if response.status_code == 304:
+        gdf = leer_cache()
+        if gdf is not None:
+            try:
+                ruta_parquet.touch()  # Revalidado: cuenta como fresco durante otra ventana de vigencia
+            except OSError:
+                pass
+            return gdf
+        response = session.get(url, timeout=30)  # El parquet no se pudo leer: descarga completa
+    response.raise_for_status()
+
+    # Solo se leen los atributos que usa la aplicación: GDAL (driver de OGR) parsea el GeoJSON en C sin pasar
+    # por dicts de Python.
+    columnas = [c for c in COLUMNAS_USADAS[nombre] if c != "geometry"]
+    gdf = pyogrio.read_dataframe(response.content, columns=columnas, read_geometry=con_geometria)
+    if con_geometria and gdf.crs is None:
+        gdf = gdf.set_crs("EPSG:4326")
+    gdf = optimizar_tipos(recortar_columnas(gdf, nombre).copy())
+
+    etag = response.headers.get("ETag")
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        # Se escribe en un temporal del mismo directorio y se renombra (atómico): una escritura interrumpida
+        # nunca deja un parquet truncado con mtime reciente. El ETag viejo se quita antes de sustituir el fichero.
+        fd, ruta_tmp = tempfile.mkstemp(dir=CACHE_DIR, prefix=f"{clave}.", suffix=".tmp")
+        os.close(fd)
+        try:
+            gdf.to_parquet(ruta_tmp)
+            ruta_etag.unlink(missing_ok=True)
+            os.replace(ruta_tmp, ruta_parquet)
+        finally:
+            Path(ruta_tmp).unlink(missing_ok=True)
+        if etag:
+            ruta_etag.write_text(etag)
+        else:
+            ruta_etag.unlink(missing_ok=True)  # Sin ETag solo vale la vigencia; no revalidar con uno viejo
+    except OSError:
+        pass  # Sin caché en disco (p. ej. sistema de ficheros de solo lectura); se usa la descarga
+
+    return gdf
+
+# --- Geometría simplificada para visualización ---
+# Douglas-Peucker con preservación de topología y coordenadas ajustadas a una rejilla de 1e-5 grados (~1 m):
+# el GeoJSON que llega al navegador lleva 5 decimales. La tolerancia (grados EPSG:4326 a la latitud de Bogotá)
+# depende del zoom al que se dibuja cada capa: localidades a escala de ciudad (~20 m), manzanas a nivel de calle (~5 m).
+# "geom_lo" alimenta los mapas; "geometry" se conserva a precisión completa para los cálculos.
+TOLERANCIA_SIMPLIFICACION = {"localidades": 0.0002, "manzanas": 0.00005}
+PRECISION_VISUALIZACION = 0.00001
+
+# --- Sesión HTTP única del proceso: el pool conserva las conexiones TCP/TLS entre descargas y revalidaciones ---
+MAX_REINTENTOS = 3
+
+@st.cache_resource
+def sesion_http():
+    session = requests.Session()
+    # Reintentos con backoff en urllib3; pool dimensionado para las descargas en paralelo
+    retry = Retry(total=MAX_REINTENTOS, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504))
+    session.mount("https://", HTTPAdapter(pool_connections=5, pool_maxsize=5, max_retries=retry))
+    # GeoJSON comprime muy bien: se piden gzip y, si urllib3 puede decodificarlos (paquete brotli), br/zstd
+    session.headers["Accept-Encoding"] = ACCEPT_ENCODING
+    return session
+
+# --- Fuentes de datos: las capas base se cargan al arrancar; las de contexto, al entrar al Bloque 4 ---
+DATASETS_BASE = {
+    "localidades": "https://github.com/andres-fuentex/tfm-avm-bogota/raw/main/datos_visualizacion/datos_geograficos_geo/dim_localidad.geojson",
+    "areas": "https://github.com/andres-fuentex/tfm-avm-bogota/raw/main/datos_visualizacion/datos_geograficos_geo/dim_area.geojson",
+    "manzanas": "https://github.com/andres-fuentex/tfm-avm-bogota/raw/main/datos_visualizacion/datos_geograficos_geo/tabla_hechos.geojson",
+}
+DATASETS_CONTEXTO = {
+    "transporte": "https://github.com/andres-fuentex/tfm-avm-bogota/raw/main/datos_visualizacion/datos_geograficos_geo/dim_transporte.geojson",
+    "colegios": "https://github.com/andres-fuentex/tfm-avm-bogota/raw/main/datos_visualizacion/datos_geograficos_geo/dim_colegios.geojson",
+}
+
+# --- Descarga en paralelo de un grupo de datasets con barra de progreso; None si alguno falla ---
+def descargar_datasets(datasets):
     dataframes = {}
     total = len(datasets)
     progress_bar = st.progress(0, text="Iniciando carga de datos...")
 
-    for idx, (nombre, url) in enumerate(datasets.items(), start=1):
-        progress_text = f"Cargando {nombre} ({idx}/{total})..."
-        progress_bar.progress(idx / total, text=progress_text)
-        
-        max_retries = 3
-        retry_delay = 2
+    session = sesion_http()
+    with ThreadPoolExecutor(max_workers=total) as executor:
+        futuros = {executor.submit(descargar_dataset, session, nombre, url): nombre for nombre, url in datasets.items()}
 
-        for attempt in range(max_retries):
+        for idx, futuro in enumerate(as_completed(futuros), start=1):
+            nombre = futuros[futuro]
             try:
-                response = requests.get(url, timeout=30)
-                response.raise_for_status()
-                
-                # Leer el contenido como JSON usando la librería json
-                geojson_data = json.loads(response.text)
-                
-                # Crear el GeoDataFrame desde el JSON
-                dataframes[nombre] = gpd.GeoDataFrame.from_features(geojson_data["features"], crs="EPSG:4326")
-                break  # Si la carga tiene éxito, salir del bucle
-            
+                dataframes[nombre] = futuro.result()
             except requests.exceptions.RequestException as e:
-                st.warning(f"Intento {attempt + 1}/{max_retries} fallido al cargar {nombre}: {e}")
-                if attempt < max_retries - 1:
-                    time.sleep(retry_delay)  # Esperar antes de reintentar
-                else:
-                    st.error(f"Error al cargar {nombre} después de {max_retries} intentos: {e}")
-                    return None  # Detener la carga si no se puede descargar después de varios intentos
-            except json.JSONDecodeError as e:
-                st.error(f"Error al decodificar JSON para {nombre}: {e}. Detalle: {e}")
+                st.error(f"Error al cargar {nombre} después de {MAX_REINTENTOS} intentos: {e}")
+                return None  # Detener la carga si no se puede descargar después de varios intentos
+            except pyogrio.errors.DataSourceError as e:
+                st.error(f"Error al leer el GeoJSON de {nombre}: {e}")
                 return None # No reintentar si el problema es el JSON
             except Exception as e:
                 st.error(f"Error al procesar {nombre}: {e}")
                 return None
 
+            progress_bar.progress(idx / total, text=f"Cargado {nombre} ({idx}/{total})...")
+
     progress_bar.empty()
     return dataframes
 
+# cache_resource: todas las sesiones y reruns comparten el mismo objeto, sin copiarlo ni serializarlo.
+# Los bloques no deben modificar estos GeoDataFrames in situ (trabajan sobre filtros o .copy()).
+@st.cache_resource
+def cargar_datasets():
+    dataframes = descargar_datasets(DATASETS_BASE)
+    if dataframes is None:
+        return None
+
+    for nombre, tolerancia in TOLERANCIA_SIMPLIFICACION.items():
+        simplificada = dataframes[nombre].geometry.simplify(tolerancia, preserve_topology=True)
+        dataframes[nombre]["geom_lo"] = simplificada.set_precision(PRECISION_VISUALIZACION)
+
+    # Manzanas indexadas por id (se conserva también la columna): los bloques buscan su fila en el índice hash
+    manzanas = dataframes["manzanas"] = dataframes["manzanas"].set_index("id_manzana_unif", drop=False).rename_axis(None)
+
+    # Geometrías de manzanas ya proyectadas a MAGNA-SIRGAS (EPSG:3116) e indexadas por id, para buffers y centroides
+    dataframes["manzanas_3116"] = gpd.GeoSeries(manzanas.geometry.to_crs(epsg=3116).values, index=manzanas.index)
+
+    # Uso POT de cada manzana resuelto una sola vez por sesión (equivale a un merge left por id_area)
+    uso_por_area = dataframes["areas"].drop_duplicates("id_area").set_index("id_area")["uso_pot_simplificado"]
+    usos = manzanas["id_area"].map(uso_por_area).astype("category")
+    if "Sin clasificación" not in usos.cat.categories:
+        usos = usos.cat.add_categories("Sin clasificación")
+    manzanas["uso_pot_simplificado"] = usos.fillna("Sin clasificación")
+
+    # Particiones por localidad, construidas una vez: el Bloque 3 obtiene su subconjunto con una búsqueda en dict
+    dataframes["manzanas_por_localidad"] = dict(tuple(manzanas.groupby("num_localidad", sort=False)))
+
+    # Extensiones (minx, miny, maxx, maxy) calculadas una vez para centrar los mapas sin recorrer geometrías en cada rerun
+    dataframes["bounds_localidades"] = tuple(dataframes["localidades"].total_bounds)
+    dataframes["bounds_manzanas_por_localidad"] = {
+        cod: tuple(grupo.total_bounds) for cod, grupo in dataframes["manzanas_por_localidad"].items()
+    }
+
+    # Paleta estable por uso POT, calculada una sola vez sobre todas las categorías de áreas
+    dataframes["color_map"] = construir_color_map(dataframes["areas"])
+
+    return dataframes
+
+# Transporte y colegios solo los usa el Bloque 4: quien no llega a ese paso no los descarga
+@st.cache_resource
+def cargar_datasets_contexto():
+    return descargar_datasets(DATASETS_CONTEXTO)
+
+# --- Rejilla raster de localidades (uint8 con num_localidad, 0 = fuera) para resolver clics del Bloque 2 ---
+# Las celdas que cruza un límite se marcan con CELDA_FRONTERA y se resuelven con contains_xy (prueba exacta).
+CELDA_FRONTERA = 255
+
+@st.cache_resource(show_spinner=False)
+def rasterizar_localidades(_localidades, resolucion=4096):
+    minx, miny, maxx, maxy = _localidades.total_bounds
+    escala_x = resolucion / (maxx - minx)
+    escala_y = resolucion / (maxy - miny)
+    imagen = Image.new("L", (resolucion, resolucion), 0)
+
+    def a_pixeles(anillo):
+        xy = shapely.get_coordinates(anillo)
+        return list(zip((xy[:, 0] - minx) * escala_x, (maxy - xy[:, 1]) * escala_y))
+
+    poligonos = [
+        (poligono, int(codigo))
+        for geom, codigo in zip(_localidades.geometry, _localidades["num_localidad"])
+        for poligono in getattr(geom, "geoms", [geom])
+    ]
+    # Cada polígono se rasteriza en su propia máscara (exterior 255, huecos 0) y se pega con ella: así sus
+    # huecos no borran una localidad contenida en ellos, dibujada antes, y el resultado no depende del orden.
+    for poligono, codigo in poligonos:
+        mascara = Image.new("L", imagen.size, 0)
+        dibujo_mascara = ImageDraw.Draw(mascara)
+        dibujo_mascara.polygon(a_pixeles(poligono.exterior), fill=255)
+        for hueco in poligono.interiors:
+            dibujo_mascara.polygon(a_pixeles(hueco), fill=0)
+        imagen.paste(codigo, mask=mascara)
+    # Los límites se trazan en una máscara aparte y se dilatan un píxel (MaxFilter 3x3): la línea de 1 px solo
+    # marca una celda por paso, y en un límite diagonal una celda cruzada podía quedarse con el código del
+    # polígono pegado en último lugar. Dilatada, toda celda que cruza un límite queda como CELDA_FRONTERA.
+    bordes = Image.new("L", imagen.size, 0)
+    dibujo_bordes = ImageDraw.Draw(bordes)
+    for poligono, _ in poligonos:
+        for anillo in [poligono.exterior, *poligono.interiors]:
+            dibujo_bordes.line(a_pixeles(anillo), fill=255, width=1)
+    mascara_bordes = bordes.filter(ImageFilter.MaxFilter(3))
+    imagen.paste(CELDA_FRONTERA, mask=mascara_bordes)
+    grid = np.array(imagen)
+
+    # Comprobación contra la prueba exacta en las celdas contiguas a la franja de frontera: no las cruza ningún
+    # límite, así que la celda entera está en una sola localidad y su centro basta para validarla. Si la rejilla
+    # diera otra localidad que contains_xy, la celda pasa a CELDA_FRONTERA y el clic se resuelve con GEOS.
+    contiguas = np.asarray(mascara_bordes.filter(ImageFilter.MaxFilter(3))).astype(bool) & (grid != CELDA_FRONTERA)
+    fila, col = np.nonzero(contiguas)
+    lng = minx + (col + 0.5) / escala_x
+    lat = maxy - (fila + 0.5) / escala_y
+    indice_punto, indice_localidad = _localidades.sindex.query(shapely.points(lng, lat), predicate="within")
+    exacto = np.zeros(len(fila), dtype=np.int64)
+    exacto[indice_punto] = _localidades["num_localidad"].values[indice_localidad]
+    discrepantes = grid[fila, col] != exacto
+    grid[fila[discrepantes], col[discrepantes]] = CELDA_FRONTERA
+
+    return grid, (minx, maxy, escala_x, escala_y)
+
+# --- Paleta RGB (uint8) para deck.gl: una fila por uso POT del color_map y una última fila por defecto ---
+def paleta_rgb(color_map):
+    colores = list(color_map.values()) + ["#2b2b2b"]
+    return np.array([list(bytes.fromhex(c.lstrip('#'))) for c in colores], dtype=np.uint8)
+
+# --- Preparación cacheada de las manzanas de una localidad (Bloque 3) ---
+# Los parámetros con guion bajo no se hashean: los datasets son fijos en el proceso, la clave es la localidad.
+# cache_resource devuelve el mismo objeto en cada rerun (sin deserializar el frame y el GeoJSON): los bloques
+# siguientes lo tratan como de solo lectura y copian antes de añadir columnas.
+@st.cache_resource(ttl=3600, show_spinner=False)
+def preparar_manzanas(cod_localidad, _manzanas_por_localidad, _color_map):
+    if cod_localidad not in _manzanas_por_localidad:
+        return gpd.GeoDataFrame(), None
+    particion = _manzanas_por_localidad[cod_localidad]
+
+    # El color de cada manzana es una propiedad precalculada que la capa lee tal cual (sin función de estilo por feature).
+    # Los códigos de categoría indexan la paleta; los usos fuera del color_map (código -1) caen en la fila por defecto.
+    # assign devuelve un frame nuevo sin tocar la partición compartida (con Copy-on-Write no copia la geometría).
+    codigos = pd.Categorical(particion["uso_pot_simplificado"], categories=list(_color_map)).codes
+    manzanas_sel = particion.assign(color_rgb=paleta_rgb(_color_map)[codigos].tolist())
+
+    # Construir el GeoJSON para la capa deck.gl en una sola pasada (solo las propiedades que usa el mapa)
+    manzanas_geojson = manzanas_sel[["id_manzana_unif", "color_rgb", "geom_lo"]].set_geometry("geom_lo").to_geo_dict(drop_id=True)
+    return manzanas_sel, manzanas_geojson
+
+# --- Fila de la manzana elegida dentro de su localidad (vacía si el código no existe) ---
+# Búsqueda en el índice por id_manzana_unif en lugar de comparar la columna entera en cada bloque.
+def buscar_manzana(manzanas_localidad, id_manzana):
+    if id_manzana in manzanas_localidad.index:
+        return manzanas_localidad.loc[[id_manzana]]
+    return manzanas_localidad.iloc[:0]
+
+# --- Centroide y buffers de la manzana en EPSG:4326 (Bloques 4 y 5) ---
+# Todas las geometrías se reproyectan en una sola llamada a to_crs y el resultado queda cacheado por manzana.
+RADIOS_BUFFER = (300, 500, 800, 1000)
+
+@st.cache_data(ttl=3600)
+def entorno_manzana(id_manzana, _manzanas_3116):
+    manzana = _manzanas_3116.loc[id_manzana]
+    # quad_segs=16 reproduce la resolución por defecto de GeoSeries.buffer
+    buffers = shapely.buffer(manzana, np.array(RADIOS_BUFFER), quad_segs=16)
+    geoms_wgs = gpd.GeoSeries([shapely.centroid(manzana), *buffers], crs=_manzanas_3116.crs).to_crs(epsg=4326)
+    return geoms_wgs.iloc[0], dict(zip(RADIOS_BUFFER, geoms_wgs.iloc[1:]))
+
+# --- Contorno exterior de un (Multi)Polígono como arrays lon/lat para Scattermapbox ---
+# Las partes de un MultiPolygon se separan con una fila NaN para que Plotly no las una. Se devuelven arrays
+# NumPy (Plotly los serializa como binario tipado) sin crear un objeto Python por vértice.
+def contorno_lon_lat(geom):
+    anillos = shapely.get_exterior_ring(shapely.get_parts(geom))
+    xy, parte = shapely.get_coordinates(anillos, return_index=True)
+    xy = np.insert(xy, np.flatnonzero(np.diff(parte)) + 1, np.nan, axis=0)
+    return xy[:, 0], xy[:, 1]
+
+# --- PNG recomprimido con zlib al máximo antes de incrustarlo: base64 crece 4:3 con el tamaño de entrada ---
+def optimizar_png(png):
+    buffer = BytesIO()
+    Image.open(BytesIO(png)).save(buffer, format="PNG", optimize=True)
+    return buffer.getvalue()
+
+# --- Exportación con Kaleido (PNG recomprimido) ---
+def exportar_figura(fig, formato="png"):
+    imagen = pio.to_image(fig, format=formato, engine='kaleido')
+    if formato == "png":
+        imagen = optimizar_png(imagen)
+    return imagen
+
+# Cacheada por la especificación JSON de la figura y el formato: evita relanzar Chromium en cada rerun
+# cuando la figura no ha cambiado. Acotada (como las demás cachés de imágenes): en un servidor multiusuario
+# cada manzana distinta añade entradas que, sin límite, no se liberarían nunca.
+@st.cache_data(max_entries=32, ttl=3600, show_spinner=False)
+def fig_a_imagen(fig_json, formato="png"):
+    return exportar_figura(pio.from_json(fig_json), formato)
+
+# Figuras Plotly del informe y formato de exportación en el Bloque 7: las gráficas (barras, tarta, línea)
+# salen en SVG, sin rasterizar y más ligeras; el mapa de manzanas lleva teselas raster y se queda en PNG.
+FIGURAS_INFORME = {"valorm2": "svg", "dist_pot": "svg", "proyeccion": "svg", "seguridad": "svg", "manzanas": "png"}
+TIPOS_MIME = {"png": "image/png", "svg": "image/svg+xml"}
+# Gráficas que el usuario puede quitar del informe en el Bloque 7 (los mapas de contexto siempre se incluyen)
+GRAFICAS_OPCIONALES = {
+    "dist_pot": "Usos POT (500 m)",
+    "valorm2": "Comparativo valor m²",
+    "seguridad": "Seguridad",
+    "proyeccion": "Proyección valor m²",
+}
+
+# --- Imagen del informe como data URI, cacheada por contenido: los reruns del Bloque 7 no recodifican ---
+# Los SVG son texto: van sin base64 (un 33 % menos y comprimen mejor con gzip), escapando solo lo que rompería
+# la URI o el atributo src ("%", "#", comillas, saltos de línea y no-ASCII). "&", "<" y ">" también se escapan:
+# el navegador decodifica las entidades del atributo antes de que el SVG llegue al parser XML, y un "&amp;" de
+# una etiqueta (p. ej. "Comercio & Servicios") quedaría como "&" suelto. Los PNG siguen en base64.
+CARACTERES_SEGUROS_SVG = " !$()*+,-./:;=?@[]^_`{|}~"
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def imagen_data_uri(contenido, mime):
+    if mime == TIPOS_MIME["svg"]:
+        return f"data:{mime};charset=utf-8,{quote(contenido.decode('utf-8'), safe=CARACTERES_SEGUROS_SVG)}"
+    return f"data:{mime};base64,{b64encode_as_string(contenido)}"
+
+# --- Plantilla HTML del informe (Jinja2). Las imágenes llegan como data URI y los textos ya traen su HTML ---
+PLANTILLA_INFORME = """<!DOCTYPE html>
+<html lang="es">
+<head>
+    <meta charset="UTF-8">
+    <title>{{ titulo }}</title>
+    <style>
+        body { font-family: Arial, sans-serif; margin: 20px; background-color: #f9f9f9; }
+        h1 { color: #2c3e50; text-align: center; }
+        .container { display: flex; flex-direction: column; align-items: center; }
+        .text { text-align: justify; margin: 20px 0; max-width: 900px; font-size: 16px; color: #333; }
+        .images { display: flex; justify-content: center; gap: 20px; flex-wrap: wrap; max-width: 900px; margin: 0 auto; }
+        .image { flex: 1; max-width: 600px; }
+        .image img { width: 100%; height: auto; border: 1px solid #ccc; box-shadow: 2px 2px 8px rgba(0,0,0,0.1); }
+    </style>
+</head>
+{%- macro imagenes() %}
+{%- set presentes = varargs | select("in", img) | list %}
+{%- if presentes %}
+        <div class="images">
+        {%- for clave in presentes %}
+            <div class="image"><img src="{{ img[clave] }}"></div>
+        {%- endfor %}
+        </div>
+{%- endif %}
+{%- endmacro %}
+<body>
+    <div class="container">
+        <h1>{{ titulo }}</h1>
+        <div class="text">{{ html_ficha }}</div>
+        <div class="text">{{ textos[0] }}</div>
+        {{- imagenes("localidad") }}
+        <div class="text">{{ textos[1] }}</div>
+        {{- imagenes("manzanas") }}
+        <div class="text">{{ textos[2] }}</div>
+        {{- imagenes("colegios", "transporte") }}
+        <div class="text">{{ textos[3] }}</div>
+        {{- imagenes("dist_pot") }}
+        <div class="text">{{ textos[4] }}</div>
+        {{- imagenes("valorm2") }}
+        <div class="text">{{ textos[5] }}</div>
+        {{- imagenes("seguridad") }}
+        <div class="text">{{ textos[6] }}</div>
+        {{- imagenes("proyeccion") }}
+    </div>
+</body>
+</html>
+"""
+
+# La plantilla se compila una vez por proceso; cada informe solo rellena los campos dinámicos
+@st.cache_resource
+def plantilla_informe():
+    return jinja2.Template(PLANTILLA_INFORME)
+
+# --- Informe HTML completo, cacheado por sus entradas (textos, ficha e imágenes) ---
+# Si nada cambió desde el último rerun del Bloque 7 se devuelven los mismos bytes sin codificar ni unir de nuevo.
+def renderizar_informe(textos, html_ficha, img):
+    # La plantilla se recorre como generador y las piezas se unen una sola vez (sin f-string gigante)
+    return "".join(plantilla_informe().generate(
+        titulo="Informe de Análisis de Inversión Inmobiliaria",
+        html_ficha=html_ficha,
+        textos=textos,
+        img=img,
+    ))
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def construir_informe(textos, html_ficha, imagenes):
+    img = {clave: imagen_data_uri(contenido, mime) for clave, (contenido, mime) in imagenes.items()}
+    return renderizar_informe(textos, html_ficha, img).encode("utf-8")
+
+# --- Variante ZIP: el HTML referencia las imágenes como ficheros junto a él, sin base64 ---
+EXTENSIONES_MIME = {mime: formato for formato, mime in TIPOS_MIME.items()}
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def construir_informe_zip(textos, html_ficha, imagenes):
+    img = {clave: f"{clave}.{EXTENSIONES_MIME[mime]}" for clave, (_, mime) in imagenes.items()}
+    buffer = BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED, compresslevel=6) as zf:
+        zf.writestr("Informe_Valorizacion.html", renderizar_informe(textos, html_ficha, img))
+        for clave, (contenido, _) in imagenes.items():
+            zf.writestr(img[clave], contenido)
+    return buffer.getvalue()
+
+# --- Mapas estáticos del informe con matplotlib (backend Agg): se rasterizan en proceso, sin Chromium ---
+def figura_mpl_a_png(fig):
+    buffer = BytesIO()
+    fig.savefig(buffer, format="png", dpi=120, bbox_inches="tight", pil_kwargs={"optimize": True})
+    plt.close(fig)
+    return buffer.getvalue()
+
+@st.cache_data(max_entries=32, ttl=3600, show_spinner=False)
+def render_localidad_png(localidad_sel, _localidades):
+    colores = np.where(_localidades["nombre_localidad"] == localidad_sel, "red", "lightgray")
+    ax = _localidades.set_geometry("geom_lo").plot(color=colores, edgecolor="white", linewidth=0.5, figsize=(6, 6))
+    ax.set_axis_off()
+    return figura_mpl_a_png(ax.figure)
+
+# --- Mapa de manzanas de la localidad para el informe, construido y exportado una vez por localidad ---
+# La clave es solo cod_localidad: los reruns del Bloque 7 (p. ej. marcar una casilla) no reconstruyen la figura
+# ni hashean su JSON de varios MB.
+@st.cache_data(max_entries=8, ttl=3600, show_spinner=False)
+def render_manzanas_png(cod_localidad, _manzanas_localidad, _color_map, _bounds):
+    fig = px.choropleth_mapbox(
+        _manzanas_localidad,
+        # Solo geometría + id de feature: sin propiedades ni bbox por feature en el JSON de la figura
+        geojson=gpd.GeoDataFrame(geometry=_manzanas_localidad["geom_lo"]).to_geo_dict(),
+        locations=_manzanas_localidad.index,
+        color="uso_pot_simplificado",
+        color_discrete_map=_color_map,
+        mapbox_style="carto-positron",
+        center={"lon": (_bounds[0] + _bounds[2]) / 2, "lat": (_bounds[1] + _bounds[3]) / 2},
+        zoom=12,
+        opacity=0.5,
+        hover_name="id_manzana_unif"
+    )
+    fig.update_layout(margin=dict(l=0, r=0, t=40, b=0), title="Manzanas seleccionadas para el informe")
+    return exportar_figura(fig, FIGURAS_INFORME["manzanas"])
+
+@st.cache_data(max_entries=32, ttl=3600, show_spinner=False)
+def render_contexto_png(id_manzana, titulo, color, _buffer_wgs, _manzana_geom, _puntos_xy):
+    fig, ax = plt.subplots(figsize=(6, 6))
+    gpd.GeoSeries([_buffer_wgs], crs="EPSG:4326").plot(ax=ax, facecolor=color, edgecolor=color, alpha=0.15)
+    gpd.GeoSeries([_buffer_wgs.exterior], crs="EPSG:4326").plot(ax=ax, color=color, linewidth=1)
+    if _manzana_geom is not None:
+        gpd.GeoSeries([_manzana_geom], crs="EPSG:4326").plot(ax=ax, facecolor="green", edgecolor="darkgreen", alpha=0.5)
+    if len(_puntos_xy):
+        ax.scatter(_puntos_xy[:, 0], _puntos_xy[:, 1], color=color, s=40, zorder=3)
+    ax.set_title(titulo)
+    ax.set_axis_off()
+    return figura_mpl_a_png(fig)
+
+# --- Estilo fijo de la capa de localidades del Bloque 2 (el mismo dict para todas las features) ---
+ESTILO_LOCALIDAD = {"fillColor": "#3388ff", "color": "black", "weight": 1, "fillOpacity": 0.2}
+ESTILO_LOCALIDAD_RESALTADA = {"weight": 2, "color": "red"}
+
+# --- GeoJSON de localidades para el mapa folium del Bloque 2, convertido una vez por proceso ---
+# El Map se crea en cada rerun (st_folium lo renderiza y modifica), pero reutiliza este dict ya serializable.
+@st.cache_resource(show_spinner=False)
+def localidades_geojson(_localidades):
+    return _localidades[["nombre_localidad", "geom_lo"]].set_geometry("geom_lo").to_geo_dict(drop_id=True)
+
+def construir_mapa_localidades(localidades, bounds):
+    center = [(bounds[1] + bounds[3]) / 2, (bounds[0] + bounds[2]) / 2]
+
+    mapa = folium.Map(location=center, zoom_start=11, tiles="CartoDB positron")
+
+    folium.GeoJson(
+        localidades_geojson(localidades),
+        style_function=lambda feature: ESTILO_LOCALIDAD,
+        highlight_function=lambda feature: ESTILO_LOCALIDAD_RESALTADA,
+        tooltip=folium.GeoJsonTooltip(fields=["nombre_localidad"], labels=False)
+    ).add_to(mapa)
+    return mapa
+
 # --- Control de flujo ---
+# Navegación: el paso se cambia en el callback del botón, que Streamlit ejecuta antes del rerun del clic,
+# así la página nueva se dibuja en ese mismo rerun sin un st.rerun() adicional.
+def ir_a_paso(paso):
+    st.session_state.step = paso
+
+def reiniciar_app():
+    st.session_state.clear()
+    st.session_state.step = 1
+
 if "step" not in st.session_state:
     st.session_state.step = 1
 
+# --- Datos: cada bloque lee la instancia cacheada; en session_state solo queda el estado de la interacción ---
+with st.spinner('Cargando datasets...'):
+    datos = cargar_datasets()
+
+if datos is None and st.session_state.step > 1:
+    st.error("❌ No se cargaron los datos. Por favor, reinicia la aplicación.")
+    st.stop()
+
 # --- Bloque 1: Carga de datos ---
 if st.session_state.step == 1:
     st.markdown(
@@ -95,17 +618,11 @@ if st.session_state.step == 1:
         Bienvenido al sistema de valorización automatizada de manzanas catastrales en Bogotá.
         """
     )
-    with st.spinner('Cargando datasets...'):
-        dataframes = cargar_datasets()
 
-    if dataframes:  # Verificar que la carga de datos fue exitosa
+    if datos:  # Verificar que la carga de datos fue exitosa
         st.success('✅ Todos los datos han sido cargados correctamente.')
 
-        if st.button("Iniciar Análisis"):
-            for nombre, df in dataframes.items():
-                st.session_state[nombre] = df
-            st.session_state.step = 2
-            st.rerun()
+        st.button("Iniciar Análisis", on_click=ir_a_paso, args=(2,))
     else:
         st.error("❌ Error al cargar los datasets. Por favor, revise las URLs o la conexión a Internet.")
 
@@ -114,32 +631,26 @@ elif st.session_state.step == 2:
     st.header("🌆 Selección de Localidad")
     st.markdown("Haz clic en la localidad que te interesa:")
 
-    localidades = st.session_state.localidades
-    if localidades is None:
-        st.error("❌ No se cargaron los datos de las localidades. Por favor, reinicia la aplicación.")
-        st.stop()
-
-    bounds = localidades.total_bounds
-    center = [(bounds[1] + bounds[3]) / 2, (bounds[0] + bounds[2]) / 2]
-
-    mapa = folium.Map(location=center, zoom_start=11, tiles="CartoDB positron")
-
-    folium.GeoJson(
-        localidades,
-        style_function=lambda feature: {"fillColor": "#3388ff", "color": "black", "weight": 1, "fillOpacity": 0.2},
-        highlight_function=lambda feature: {"weight": 2, "color": "red"},
-        tooltip=folium.GeoJsonTooltip(fields=["nombre_localidad"], labels=False)
-    ).add_to(mapa)
+    localidades = datos["localidades"]
 
+    mapa = construir_mapa_localidades(localidades, datos["bounds_localidades"])
     result = st_folium(mapa, width=700, height=500, returned_objects=["last_clicked"])
 
     clicked = result.get("last_clicked")
     if clicked and "lat" in clicked and "lng" in clicked:
-        punto = Point(clicked["lng"], clicked["lat"])
-        for _, row in st.session_state.localidades.iterrows():
-            if row["geometry"].contains(punto):
-                st.session_state.localidad_clic = row["nombre_localidad"]
-                break
+        # El clic se resuelve con un acceso a la rejilla raster en lugar de un contains por polígono
+        grid, (minx, maxy, escala_x, escala_y) = rasterizar_localidades(localidades)
+        # floor (no int): un clic justo encima o a la izquierda del bbox debe caer fuera, no en la fila/columna 0
+        fila = math.floor((maxy - clicked["lat"]) * escala_y)
+        col = math.floor((clicked["lng"] - minx) * escala_x)
+        codigo = grid[fila, col] if 0 <= fila < grid.shape[0] and 0 <= col < grid.shape[1] else 0
+        if codigo == CELDA_FRONTERA:
+            # Celda sobre un límite: contains_xy evalúa todas las localidades en un solo bucle de GEOS,
+            # sin construir un Point ni iterar en Python
+            dentro = shapely.contains_xy(localidades.geometry.values, clicked["lng"], clicked["lat"])
+            codigo = localidades["num_localidad"].values[dentro][0] if dentro.any() else 0
+        if codigo:
+            st.session_state.localidad_clic = localidades.loc[localidades["num_localidad"] == codigo, "nombre_localidad"].iat[0]
         else:
             st.session_state.localidad_clic = None
             st.warning("⚠️ No se encontró ninguna localidad en la ubicación seleccionada.") # Mensaje mejorado
@@ -153,203 +664,127 @@ elif st.session_state.step == 2:
             st.session_state.step = 3
             st.rerun()
 
-    if st.button("🔄 Volver al Inicio"):
-        st.session_state.step = 1
-        st.rerun()
+    st.button("🔄 Volver al Inicio", on_click=ir_a_paso, args=(1,))
 
     if "localidad_sel" not in st.session_state:
         st.info("Selecciona una localidad y confírmala para continuar.")
 
-# --- Bloque 3: Selección de Manzana ---
-# --- Bloque 3: Selección de Manzana ---
 # --- Bloque 3: Selección de Manzana con Copia Manual ---
 elif st.session_state.step == 3:
     st.subheader(f"🏘️ Análisis y Selección de Manzana en {st.session_state.localidad_sel}")
 
-    import streamlit.components.v1 as components
-    import geopandas as gpd
-    import plotly.express as px
-    import json
-    import plotly.io as pio
-    from io import BytesIO
-   
-
-    localidades = st.session_state.localidades
-    areas = st.session_state.areas
-    manzanas = st.session_state.manzanas
+    localidades = datos["localidades"]
 
     localidad_sel = st.session_state.localidad_sel
-    cod_localidad = localidades[localidades["nombre_localidad"] == localidad_sel]["num_localidad"].values[0]
+    cod_localidad = localidades[localidades["nombre_localidad"] == localidad_sel]["num_localidad"].iat[0]
 
     # --- Primer mapa (Plotly): Localidad resaltada ---
     st.markdown("### 🗺️ Localidad Seleccionada (Mapa de Referencia)")
-    localidades["seleccionada"] = localidades["nombre_localidad"] == localidad_sel
-    bounds = localidades[localidades["seleccionada"]].total_bounds
+    # Solo se envía el polígono seleccionado; el resto de localidades lo aporta el mapa base
+    geom_localidad = localidades.loc[localidades["nombre_localidad"] == localidad_sel, "geom_lo"].iat[0]
+    bounds = geom_localidad.bounds
     center = {"lon": (bounds[0] + bounds[2]) / 2, "lat": (bounds[1] + bounds[3]) / 2}
-
-    fig_localidad = px.choropleth_mapbox(
-        localidades,
-        geojson=localidades.geometry,
-        locations=localidades.index,
-        color="seleccionada",
-        color_discrete_map={True: "red", False: "lightgray"},
-        hover_name="nombre_localidad",
-        mapbox_style="carto-positron",
-        center=center,
-        zoom=10
+    lon_sel, lat_sel = contorno_lon_lat(geom_localidad)
+
+    fig_localidad = go.Figure(go.Scattermapbox(
+        lon=lon_sel, lat=lat_sel,
+        mode='lines', fill='toself', name=localidad_sel,
+        fillcolor='rgba(255,0,0,0.4)', line=dict(color='red'),
+        hoverinfo='name'
+    ))
+    fig_localidad.update_layout(
+        mapbox_style="carto-positron", mapbox_center=center, mapbox_zoom=10,
+        margin={"r":0,"t":0,"l":0,"b":0}, showlegend=False
     )
-    fig_localidad.update_layout(margin={"r":0,"t":0,"l":0,"b":0})
     st.plotly_chart(fig_localidad, use_container_width=True)
 
     # Guardar imagen del mapa de localidad para el informe
-    buffer_localidad = BytesIO()
-    pio.write_image(fig_localidad, buffer_localidad, format='png', engine='kaleido')
-    st.session_state.buffer_localidad = buffer_localidad
+    st.session_state.buffer_localidad = BytesIO(render_localidad_png(localidad_sel, localidades))
 
-    # --- Preparación de manzanas + colores ---
-    areas_sel = areas[areas["num_localidad"] == cod_localidad].copy()
-    manzanas_sel = manzanas[manzanas["num_localidad"] == cod_localidad].copy()
+    # --- Preparación de manzanas + colores (cacheada por localidad) ---
+    manzanas_sel, manzanas_geojson = preparar_manzanas(
+        cod_localidad, datos["manzanas_por_localidad"], datos["color_map"]
+    )
+    manzana_clic = ""
 
     if manzanas_sel.empty:
         st.warning("⚠️ No se encontraron manzanas para la localidad seleccionada.")
-        if st.button("🔙 Volver a Selección de Localidad"):
-            st.session_state.step = 2
-            st.rerun()
+        st.button("🔙 Volver a Selección de Localidad", on_click=ir_a_paso, args=(2,))
     else:
         st.markdown("""
         ### 🖱️ Haz clic sobre la manzana para seleccionarla
         ✅ El código de la manzana seleccionada aparecerá en la caja de abajo
-        ✅ ¡Copia el código y pégalo en el campo para confirmar!
+        ✅ Revisa el código y confirma la selección
         """)
 
-        if not areas_sel.empty:
-            manzanas_sel = manzanas_sel.merge(
-                areas_sel[["id_area", "uso_pot_simplificado"]],
-                on="id_area",
-                how="left"
-            )
-        else:
-            manzanas_sel["uso_pot_simplificado"] = "Sin clasificación"
-
-        manzanas_sel["uso_pot_simplificado"] = manzanas_sel["uso_pot_simplificado"].fillna("Sin clasificación")
-
-        cats = manzanas_sel["uso_pot_simplificado"].unique().tolist()
-        palette = px.colors.qualitative.Plotly
-        color_map = {cat: palette[i % len(palette)] for i, cat in enumerate(cats)}
-        if "Sin clasificación" not in color_map:
-            color_map["Sin clasificación"] = "#2b2b2b"
-
-        manzanas_sel["color"] = manzanas_sel["uso_pot_simplificado"].apply(lambda x: color_map.get(x, "#2b2b2b"))
-
-        # Construir el GeoJSON con color y preparar mapa
-        manzanas_features = []
-        for _, row in manzanas_sel.iterrows():
-            manzanas_features.append({
-                "type": "Feature",
-                "geometry": json.loads(gpd.GeoSeries([row["geometry"]]).to_json())["features"][0]["geometry"],
-                "properties": {
-                    "id_manzana_unif": row["id_manzana_unif"],
-                    "color": row["color"]
-                }
-            })
-
-        manzanas_geojson = {
-            "type": "FeatureCollection",
-            "features": manzanas_features
-        }
-
-        geojson_text = json.dumps(manzanas_geojson)
-
-        # Mostrar mapa y caja HTML
-        components.html(f"""
-            <div id="map" style="height: 500px;"></div>
-            <p><b>🔎 Código de la manzana seleccionada (¡copia este valor!):</b></p>
-            <input type="text" id="selected_id_input" value="" style="width: 100%; padding: 5px;" readonly>
-
-            <script src="https://unpkg.com/leaflet@1.7.1/dist/leaflet.js"></script>
-            <link rel="stylesheet" href="https://unpkg.com/leaflet@1.7.1/dist/leaflet.css"/>
-
-            <script>
-                const map = L.map('map').setView([{center['lat']}, {center['lon']}], 13);
-                L.tileLayer('https://tile.openstreetmap.org/{{z}}/{{x}}/{{y}}.png', {{
-                    maxZoom: 18,
-                    attribution: '© OpenStreetMap contributors'
-                }}).addTo(map);
-
-                const manzanas = {geojson_text};
-
-                function style(feature) {{
-                    return {{
-                        fillColor: feature.properties.color,
-                        weight: 1,
-                        opacity: 1,
-                        color: 'black',
-                        fillOpacity: 0.5
-                    }};
-                }}
-
-                function highlightStyle() {{
-                    return {{
-                        fillColor: 'orange',
-                        weight: 2,
-                        color: 'red',
-                        fillOpacity: 0.7
-                    }};
-                }}
-
-                let selectedLayer = null;
-
-                function onEachFeature(feature, layer) {{
-                    layer.on({{
-                        click: function(e) {{
-                            if (selectedLayer) {{
-                                geojson.resetStyle(selectedLayer);
-                            }}
-                            selectedLayer = layer;
-                            layer.setStyle(highlightStyle());
-                            document.getElementById("selected_id_input").value = feature.properties.id_manzana_unif;
-                        }}
-                    }});
-                layer.bindTooltip("Manzana: " + feature.properties.id_manzana_unif);
-                }}
-
-                const geojson = L.geoJSON(manzanas, {{
-                    style: style,
-                    onEachFeature: onEachFeature
-                }}).addTo(map);
-
-                map.fitBounds(geojson.getBounds());
-            </script>
-        """, height=620)
-
-        # Confirmación manual (el usuario copia el valor)
-    manzana_input = st.text_input("✅ Pega aquí el código de la manzana seleccionada para confirmar:")
+        # Mapa deck.gl (WebGL): el clic sobre una manzana vuelve a Streamlit como selección
+        bounds_m = datos["bounds_manzanas_por_localidad"][cod_localidad]
+        capa_manzanas = pdk.Layer(
+            "GeoJsonLayer",
+            data=manzanas_geojson,
+            id="manzanas",
+            get_fill_color="properties.color_rgb",
+            get_line_color=[0, 0, 0],
+            line_width_min_pixels=1,
+            opacity=0.5,
+            stroked=True,
+            pickable=True,
+            auto_highlight=True,
+            highlight_color=[255, 165, 0, 180]
+        )
+        vista = pdk.ViewState(
+            longitude=(bounds_m[0] + bounds_m[2]) / 2,
+            latitude=(bounds_m[1] + bounds_m[3]) / 2,
+            zoom=13
+        )
+        evento = st.pydeck_chart(
+            pdk.Deck(
+                layers=[capa_manzanas],
+                initial_view_state=vista,
+                map_provider="carto",
+                map_style=pdk.map_styles.CARTO_LIGHT,
+                tooltip={"text": "Manzana: {id_manzana_unif}"}
+            ),
+            on_select="rerun",
+            selection_mode="single-object",
+            key=f"mapa_manzanas_{cod_localidad}",
+            height=500
+        )
+
+        # La selección se conserva entre reruns en el estado del widget (clave por localidad)
+        seleccion = evento.selection.objects.get("manzanas", [])
+        if seleccion:
+            manzana_clic = seleccion[0].get("properties", seleccion[0])["id_manzana_unif"]
+            st.info(f"🔎 Manzana seleccionada: **{manzana_clic}**")
+
+        # Confirmación: el campo se rellena con la manzana clicada y admite escribir un código a mano
+    manzana_input = st.text_input(
+        "✅ Código de la manzana seleccionada para confirmar:",
+        value=manzana_clic
+    )
 
     if st.button("✅ Confirmar Manzana Seleccionada"):
         if manzana_input:
             st.session_state.manzana_sel = manzana_input
             st.session_state.manzanas_localidad_sel = manzanas_sel
+            # Las figuras del informe son de la manzana anterior: si la nueva omite alguna (p. ej. proyección
+            # incompleta), no debe exportarse la vieja
+            for clave in FIGURAS_INFORME:
+                st.session_state.pop(f"fig_{clave}", None)
+                st.session_state.pop(f"buffer_{clave}", None)
             st.session_state.step = 4
             st.rerun()
         else:
-            st.warning("Debes pegar el código de la manzana seleccionada.")
+            st.warning("Debes seleccionar una manzana en el mapa o escribir su código.")
 
     col1, col2 = st.columns(2)
     with col1:
-        if st.button("🔙 Volver a Selección de Localidad"):
-            st.session_state.step = 2
-            st.rerun()
+        st.button("🔙 Volver a Selección de Localidad", on_click=ir_a_paso, args=(2,))
     with col2:
-        if st.button("🔄 Volver al Inicio"):
-            st.session_state.step = 1
-            st.rerun()
+        st.button("🔄 Volver al Inicio", on_click=ir_a_paso, args=(1,))
 ### OJO CON ESTE CAMBIO
         st.session_state.manzanas_localidad_sel = manzanas_sel
-        st.session_state.color_map = color_map
 
-    def hexToRgb(hex_color):
-        hex_color = hex_color.lstrip('#')
-        return tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
 
 
 
@@ -357,58 +792,56 @@ elif st.session_state.step == 3:
 elif st.session_state.step == 4:
     st.subheader("🗺️ Análisis Contextual de la Manzana Seleccionada")
 
-    import geopandas as gpd
-    import plotly.graph_objects as go
-    import pandas as pd
-    from shapely.geometry import MultiPoint, Point
-    from io import BytesIO
-    import plotly.io as pio
-
-    manzanas = st.session_state.manzanas
-    transporte = st.session_state.transporte
-    colegios = st.session_state.colegios
+    with st.spinner('Cargando transporte y colegios...'):
+        contexto = cargar_datasets_contexto()
+    if contexto is None:
+        st.error("❌ No se cargaron los datos de transporte y colegios. Por favor, reinicia la aplicación.")
+        st.stop()
+    transporte = contexto["transporte"]
+    colegios = contexto["colegios"]
     id_manzana = st.session_state.manzana_sel
-    
-    manzana_sel = manzanas[manzanas["id_manzana_unif"] == id_manzana]
+
+    # La manzana se busca en la partición de la localidad elegida en el Bloque 3, no en toda Bogotá
+    manzanas_localidad = st.session_state.manzanas_localidad_sel
+    manzana_sel = buscar_manzana(manzanas_localidad, id_manzana)
 
     if manzana_sel.empty:
         st.warning("⚠️ No se encontraron datos para la manzana seleccionada.")
-        if st.button("🔙 Volver a Selección de Manzana"):
-            st.session_state.step = 3
-            st.rerun()
+        st.button("🔙 Volver a Selección de Manzana", on_click=ir_a_paso, args=(3,))
     else:
         # --- 1. Preparar la Manzana y el Centroide ---
-        manzana_proj = manzana_sel.to_crs(epsg=3116)
-        centroide = manzana_proj.geometry.centroid.to_crs(epsg=4326).iloc[0]
+        centroide, buffers_wgs = entorno_manzana(id_manzana, datos["manzanas_3116"])
         lon0, lat0 = centroide.x, centroide.y
 
         # --- 2. Contexto de TRANSPORTE ---
         st.markdown("### 🚇 Contexto de Transporte (Buffer 800m)")
         
-        buffer_transporte_proj = manzana_proj.buffer(800)
-        buffer_transporte_wgs = gpd.GeoSeries([buffer_transporte_proj.iloc[0]], crs=3116).to_crs(epsg=4326).iloc[0]
+        buffer_transporte_wgs = buffers_wgs[800]
         
+        # Para dibujar, contornos simplificados a la misma tolerancia que las manzanas (~5 m); los cálculos usan los exactos
+        tolerancia_dibujo = TOLERANCIA_SIMPLIFICACION["manzanas"]
+        lon_b, lat_b = contorno_lon_lat(buffer_transporte_wgs.simplify(tolerancia_dibujo))
         fig_transporte = go.Figure(go.Scattermapbox(
-            lat=list(buffer_transporte_wgs.exterior.xy[1]),
-            lon=list(buffer_transporte_wgs.exterior.xy[0]),
+            lat=lat_b, lon=lon_b,
             mode='lines', fill='toself', name='Buffer 800m',
             fillcolor='rgba(255,0,0,0.1)', line=dict(color='red')
         ))
 
+        lon_m, lat_m = contorno_lon_lat(manzana_sel["geom_lo"].iat[0])
         fig_transporte.add_trace(go.Scattermapbox(
-            lat=list(manzana_sel.geometry.iloc[0].exterior.xy[1]),
-            lon=list(manzana_sel.geometry.iloc[0].exterior.xy[0]),
+            lat=lat_m, lon=lon_m,
             mode='lines', fill='toself', name='Manzana',
             fillcolor='rgba(0,128,0,0.3)', line=dict(color='darkgreen')
         ))
 
-        id_combi = manzana_sel["id_combi_acceso"].iloc[0]
+        xy_t = np.empty((0, 2))
+        id_combi = manzana_sel["id_combi_acceso"].iat[0]
         if pd.notna(id_combi):
             multipunto_transporte = transporte.loc[transporte["id_combi_acceso"] == id_combi, "geometry"]
             if not multipunto_transporte.empty:
-                puntos = list(multipunto_transporte.iloc[0].geoms)
+                xy_t = shapely.get_coordinates(multipunto_transporte.iat[0])
                 fig_transporte.add_trace(go.Scattermapbox(
-                    lat=[p.y for p in puntos], lon=[p.x for p in puntos],
+                    lat=xy_t[:, 1], lon=xy_t[:, 0],
                     mode='markers', name='Estaciones', marker=dict(color='red', size=10)
                 ))
 
@@ -417,37 +850,33 @@ elif st.session_state.step == 4:
             margin={"r": 0, "t": 40, "l": 0, "b": 0}, title="Contexto de Transporte"
         )
         st.plotly_chart(fig_transporte, use_container_width=True)
-        buffer_img_transporte = BytesIO()
-        pio.write_image(fig_transporte, buffer_img_transporte, format='png', engine='kaleido')
+        buffer_img_transporte = BytesIO(render_contexto_png(
+            id_manzana, "Contexto de Transporte", "red", buffer_transporte_wgs, manzana_sel.geometry.iat[0], xy_t
+        ))
         st.session_state.buffer_transporte = buffer_img_transporte
 
         # --- 3. Contexto EDUCATIVO ---
         st.markdown("### 🏫 Contexto Educativo (Buffer 1000m)")
-        buffer_colegios_proj = manzana_proj.buffer(1000)
-        buffer_colegios_wgs = gpd.GeoSeries([buffer_colegios_proj.iloc[0]], crs=3116).to_crs(epsg=4326).iloc[0]
+        buffer_colegios_wgs = buffers_wgs[1000]
 
+        lon_b, lat_b = contorno_lon_lat(buffer_colegios_wgs.simplify(tolerancia_dibujo))
         fig_colegios = go.Figure(go.Scattermapbox(
-            lat=list(buffer_colegios_wgs.exterior.xy[1]),
-            lon=list(buffer_colegios_wgs.exterior.xy[0]),
+            lat=lat_b, lon=lon_b,
             mode='lines', fill='toself', name='Buffer 1000m',
             fillcolor='rgba(0,0,255,0.1)', line=dict(color='blue')
         ))
 
-        id_colegios = manzana_sel["id_com_colegios"].iloc[0]
+        xy_c = np.empty((0, 2))
+        id_colegios = manzana_sel["id_com_colegios"].iat[0]
         if pd.notna(id_colegios):
             colegios_filtered = colegios[colegios["id_com_colegios"] == id_colegios]
             if not colegios_filtered.empty:
-                puntos_colegios = []
-                for geom in colegios_filtered.geometry:
-                    if isinstance(geom, MultiPoint):
-                        puntos_colegios.extend(list(geom.geoms))
-                    elif isinstance(geom, Point):
-                        puntos_colegios.append(geom)
-
-                if puntos_colegios:
-                    lat_col,lon_col = zip(*[(point.y,point.x) for point in puntos_colegios])
+                # Puntos y MultiPoints se aplanan en un único array (n, 2) sin iterar en Python
+                xy_c = shapely.get_coordinates(colegios_filtered.geometry.values)
+
+                if len(xy_c):
                     fig_colegios.add_trace(go.Scattermapbox(
-                        lat=lat_col,lon=lon_col,
+                        lat=xy_c[:, 1], lon=xy_c[:, 0],
                         mode='markers', name='Colegios', marker=dict(color='blue', size=10)
                     ))
         fig_colegios.update_layout(
@@ -456,21 +885,18 @@ elif st.session_state.step == 4:
         )
         st.plotly_chart(fig_colegios, use_container_width=True)
 
-        buffer_img_colegios = BytesIO()
-        pio.write_image(fig_colegios, buffer_img_colegios, format='png', engine='kaleido')
+        buffer_img_colegios = BytesIO(render_contexto_png(
+            id_manzana, "Contexto Educativo", "blue", buffer_colegios_wgs, None, xy_c
+        ))
         st.session_state.buffer_colegios = buffer_img_colegios
     
 
     # Navegación
     col1, col2, col3 = st.columns(3)
     with col1:
-        if st.button("🔙 Volver a Selección de Manzana"):
-            st.session_state.step = 3
-            st.rerun()
+        st.button("🔙 Volver a Selección de Manzana", on_click=ir_a_paso, args=(3,))
     with col2:
-        if st.button("🔄 Volver al Inicio"):
-            st.session_state.step = 1
-            st.rerun()
+        st.button("🔄 Volver al Inicio", on_click=ir_a_paso, args=(1,))
     with col3:
         if st.button("➡️ Continuar al Análisis Comparativo", disabled=manzana_sel.empty):
             st.session_state.step = 5
@@ -483,50 +909,38 @@ elif st.session_state.step == 4:
 elif st.session_state.step == 5:
     st.subheader("📊 Análisis Comparativo y Proyección del Valor m²")
 
-    import pandas as pd
-    from io import BytesIO
-    import plotly.express as px
-    import plotly.graph_objects as go
-    import plotly.io as pio
-
-    localidades = st.session_state.localidades
-    manzanas = st.session_state.manzanas
-    areas = st.session_state.areas
+    localidades = datos["localidades"]
+    areas = datos["areas"]
     manzana_id = st.session_state.manzana_sel
-    if "colegios" in st.session_state:
-        colegios = st.session_state.colegios
-    if "transporte" in st.session_state:
-        transporte = st.session_state.transporte
-
-    manzanas_sel = st.session_state.manzanas_localidad_sel.copy()
-    color_map = st.session_state.color_map
-    manzana_sel = manzanas_sel[manzanas_sel["id_manzana_unif"] == manzana_id]
-
-    if "uso_pot_simplificado_y" in manzanas_sel.columns and "uso_pot_simplificado_x" in manzanas_sel.columns:
-        manzanas_sel["uso_pot_simplificado"] = manzanas_sel["uso_pot_simplificado_y"].combine_first(manzanas_sel["uso_pot_simplificado_x"]).fillna("Sin clasificación POT")
-    elif "uso_pot_simplificado" in manzanas_sel.columns:
-        manzanas_sel["uso_pot_simplificado"] = manzanas_sel["uso_pot_simplificado"].fillna("Sin clasificación POT")
-    else:
-        manzanas_sel["uso_pot_simplificado"] = "Sin clasificación POT"
 
-    cod_localidad = manzana_sel["num_localidad"].values[0]
-    nombre_localidad = localidades.loc[localidades["num_localidad"] == cod_localidad, "nombre_localidad"].values[0]
+    # Solo lectura: los agregados leen columnas del frame guardado, sin copiarlo (uso_pot_simplificado ya viene
+    # resuelto y sin nulos desde cargar_datasets)
+    manzanas_sel = st.session_state.manzanas_localidad_sel
+    color_map = datos["color_map"]
+    manzana_sel = buscar_manzana(manzanas_sel, manzana_id)
+
+    cod_localidad = manzana_sel["num_localidad"].iat[0]
+    nombre_localidad = localidades.loc[localidades["num_localidad"] == cod_localidad, "nombre_localidad"].iat[0]
 
     st.markdown("### 📈 Comparativo de valor m²")
 
-    id_area_manzana = manzana_sel["id_area"].values[0]
+    id_area_manzana = manzana_sel["id_area"].iat[0]
 
+    # Los agregados trabajan sobre las columnas (Series), sin materializar sub-GeoDataFrames con la geometría
+    valores_m2 = manzanas_sel["valor_m2"]
     if pd.notna(id_area_manzana):
-        manzanas_area = manzanas_sel[manzanas_sel["id_area"] == id_area_manzana]
+        valores_area = valores_m2[manzanas_sel["id_area"] == id_area_manzana]
     else:
-        manzanas_area = manzanas_sel[manzanas_sel["id_area"].isna()]
+        valores_area = valores_m2[manzanas_sel["id_area"].isna()]
 
-    promedio_area = manzanas_area["valor_m2"].mean() if not manzanas_area.empty else 0
-    valor_manzana = manzana_sel["valor_m2"].values[0]
+    promedio_area = valores_area.mean() if not valores_area.empty else 0
+    valor_manzana = manzana_sel["valor_m2"].iat[0]
 
-    buffer_300 = manzana_sel.to_crs(epsg=3116).buffer(300).to_crs(epsg=4326)
-    manzanas_buffer = manzanas_sel[manzanas_sel.geometry.intersects(buffer_300.iloc[0])]
-    promedio_buffer = manzanas_buffer["valor_m2"].mean() if not manzanas_buffer.empty else 0
+    _, buffers_wgs = entorno_manzana(manzana_id, datos["manzanas_3116"])
+    # STRtree de la localidad: se construye una vez sobre el objeto guardado en session_state y sirve a ambos buffers
+    indice_manzanas = manzanas_sel.sindex
+    valores_buffer = valores_m2.iloc[indice_manzanas.query(buffers_wgs[300], predicate="intersects")]
+    promedio_buffer = valores_buffer.mean() if not valores_buffer.empty else 0
 
     fig = go.Figure()
     fig.add_trace(go.Bar(x=["Manzana seleccionada"], y=[valor_manzana], text=[f"${valor_manzana:,.0f}"], textposition="outside", marker_color='rgba(0, 102, 204, 0.8)'))
@@ -536,18 +950,15 @@ elif st.session_state.step == 5:
     fig.update_layout(title="Comparativo de valor m² respecto al área POT y 300m a la redonda", yaxis_title="Valor por metro cuadrado", barmode="group", template="simple_white", margin=dict(l=0, r=0, t=40, b=0))
     st.plotly_chart(fig, use_container_width=True)
 
-    st.session_state.buffer_valorm2 = BytesIO(pio.to_image(fig, format='png'))
+    st.session_state.fig_valorm2 = fig.to_json()
 
     st.markdown("### 🥧 Distribución de usos POT en 500m")
 
-    buffer_uso = manzana_sel.to_crs(epsg=3116).buffer(500).to_crs(epsg=4326)
-    manzanas_buffer_uso = manzanas_sel[manzanas_sel.geometry.intersects(buffer_uso.iloc[0])]
-
-    if "uso_pot_simplificado" not in manzanas_buffer_uso.columns:
-        manzanas_buffer_uso["uso_pot_simplificado"] = "Sin clasificación POT"
-
-    conteo_uso = manzanas_buffer_uso["uso_pot_simplificado"].value_counts().reset_index()
+    usos_buffer = manzanas_sel["uso_pot_simplificado"].iloc[indice_manzanas.query(buffers_wgs[500], predicate="intersects")]
+    conteo_uso = usos_buffer.value_counts().reset_index()
     conteo_uso.columns = ["uso", "cantidad"]
+    # Con dtype categórico value_counts incluye las categorías sin manzanas en el buffer
+    conteo_uso = conteo_uso[conteo_uso["cantidad"] > 0]
 
     
 
@@ -558,7 +969,7 @@ elif st.session_state.step == 5:
         fig_pie.update_traces(textinfo='percent+label', textfont_size=14)
         fig_pie.update_layout(template="simple_white", margin=dict(l=0, r=0, t=40, b=0))
         st.plotly_chart(fig_pie, use_container_width=True)
-        st.session_state.buffer_dist_pot = BytesIO(pio.to_image(fig_pie, format='png'))
+        st.session_state.fig_dist_pot = fig_pie.to_json()
     else:
         st.warning("⚠️ No se encontraron manzanas con clasificación POT dentro del buffer de 500m.")
 
@@ -574,34 +985,25 @@ elif st.session_state.step == 5:
 
 
     if not conteo_uso.empty:
-        uso_pot_mayoritario = conteo_uso.iloc[0]["uso"]
+        uso_pot_mayoritario = conteo_uso["uso"].iat[0]
         st.session_state.uso_pot_mayoritario = uso_pot_mayoritario
     else:
         st.session_state.uso_pot_mayoritario = "Sin clasificación POT"
-    
-    st.session_state.buffer_mapa_pot = st.session_state.buffer_dist_pot
 
 
 
-    ## OJO CON ESTE BLOQUE
-    import plotly.express as px
-    import plotly.io as pio
-    from io import BytesIO
-
-    manzanas_localidad = st.session_state.manzanas_localidad_sel.copy()
-    color_map = st.session_state.color_map
 
-    import pandas as pd
+    ## OJO CON ESTE BLOQUE
 
     # Crear la ficha estilizada para el informe
     ficha_estilizada = pd.DataFrame({
     "ID Manzana": [manzana_id],
     "Localidad": [nombre_localidad],
-    "Estrato": [manzana_sel["estrato"].values[0]],
+    "Estrato": [manzana_sel["estrato"].iat[0]],
     "Valor m²": [f"${valor_manzana:,.0f}"],
     "Prom. Área POT": [f"${promedio_area:,.0f}"],
     "Prom. 300m": [f"${promedio_buffer:,.0f}"],
-    "Rentabilidad": [manzana_sel["rentabilidad"].values[0]]
+    "Rentabilidad": [manzana_sel["rentabilidad"].iat[0]]
     })
 
     st.session_state.ficha_estilizada = ficha_estilizada
@@ -613,40 +1015,29 @@ elif st.session_state.step == 5:
         fig_line.add_trace(go.Scatter(x=fechas, y=serie_proyeccion, mode="lines+markers+text", line=dict(color="royalblue", width=3), marker=dict(size=8), text=[f"${v:,.0f}" for v in serie_proyeccion], textposition="top center", textfont=dict(size=14), name="Proyección valor m²"))
         fig_line.update_layout(title=f"Evolución Proyectada del Valor m² - Manzana {manzana_id}", xaxis_title="Periodo", yaxis_title="Valor m²", template="simple_white", margin=dict(l=0, r=0, t=40, b=0))
         st.plotly_chart(fig_line, use_container_width=True)
-        st.session_state.buffer_proyeccion = BytesIO(pio.to_image(fig_line, format='png'))
+        st.session_state.fig_proyeccion = fig_line.to_json()
     else:
         st.warning("⚠️ La información de proyección del valor m² no está completa para esta manzana.")
 
     st.markdown("---")
     col1, col2 = st.columns(2)
     with col1:
-        if st.button("🔙 Volver al Análisis de Transporte y Educación"):
-            st.session_state.step = 4
-            st.rerun()
+        st.button("🔙 Volver al Análisis de Transporte y Educación", on_click=ir_a_paso, args=(4,))
     with col2:
-        if st.button("➡️ Continuar al Análisis de Seguridad"):
-            st.session_state.step = 6
-            st.rerun()
+        st.button("➡️ Continuar al Análisis de Seguridad", on_click=ir_a_paso, args=(6,))
 
     # BLOQUE 6
 elif st.session_state.step == 6:
     st.subheader("🔎 Contexto de Seguridad por Localidad")
-    import plotly.express as px
-    from io import BytesIO
-    import plotly.io as pio
 
-    localidades = st.session_state.localidades
-    manzana_sel = st.session_state.manzanas_localidad_sel[
-        st.session_state.manzanas_localidad_sel["id_manzana_unif"] == st.session_state.manzana_sel
-    ]
+    localidades = datos["localidades"]
+    manzana_sel = buscar_manzana(st.session_state.manzanas_localidad_sel, st.session_state.manzana_sel)
 
     if manzana_sel.empty:
         st.warning("⚠️ No se encontró información de la manzana seleccionada.")
-        if st.button("🔙 Volver al Bloque Anterior"):
-            st.session_state.step = 5
-            st.rerun()
+        st.button("🔙 Volver al Bloque Anterior", on_click=ir_a_paso, args=(5,))
     else:
-        cod_loc = manzana_sel["num_localidad"].values[0]
+        cod_loc = manzana_sel["num_localidad"].iat[0]
 
         df_seguridad = localidades[["nombre_localidad", "num_localidad", "cantidad_delitos", "nivel_riesgo_delictivo"]].copy()
         df_seguridad["es_localidad_actual"] = df_seguridad["num_localidad"] == cod_loc
@@ -677,257 +1068,190 @@ elif st.session_state.step == 6:
         fig.update_yaxes(categoryorder="total ascending")
         st.plotly_chart(fig, use_container_width=True)
 
-        st.session_state.buffer_seguridad = BytesIO()
-        pio.write_image(fig, st.session_state.buffer_seguridad, format='png') # Correcto: Guarda la figura en el buffer
+        st.session_state.fig_seguridad = fig.to_json()
         st.session_state.df_seguridad = df_seguridad
 
 
         col1, col2, col3 = st.columns(3)
         with col1:
-            if st.button("🔙 Volver al Análisis Comparativo"):
-                st.session_state.step = 5
-                st.rerun()
+            st.button("🔙 Volver al Análisis Comparativo", on_click=ir_a_paso, args=(5,))
         with col2:
-            if st.button("➡️ Finalizar y Descargar Informe"):
-                st.session_state.step = 7
-                st.rerun()
+            st.button("➡️ Finalizar y Descargar Informe", on_click=ir_a_paso, args=(7,))
         with col3:
-            if st.button("🔄 Reiniciar App"):
-                for key in list(st.session_state.keys()):
-                    del st.session_state[key]
-                st.session_state.step = 1
-                st.rerun()
+            st.button("🔄 Reiniciar App", on_click=reiniciar_app)
 
         if "nombre_localidad" not in st.session_state:
-            cod_localidad = manzana_sel["num_localidad"].values[0]
-            st.session_state.nombre_localidad = st.session_state.localidades.loc[
-            st.session_state.localidades["num_localidad"] == cod_localidad, "nombre_localidad"
-            ].values[0]
+            cod_localidad = manzana_sel["num_localidad"].iat[0]
+            st.session_state.nombre_localidad = datos["localidades"].loc[
+            datos["localidades"]["num_localidad"] == cod_localidad, "nombre_localidad"
+            ].iat[0]
 
             # --- Bloque 7: Generación del Informe Ejecutivo ---
 
 elif st.session_state.step == 7:
     st.subheader("📑 Generación del Informe Ejecutivo")
 
-    # --- Generación del Mapa de Manzanas para el Informe ---
-    import plotly.express as px
-    import plotly.io as pio
-    from io import BytesIO
-
-    manzanas_localidad = st.session_state.manzanas_localidad_sel.copy()
-    color_map = st.session_state.color_map
-
-    if "uso_pot_simplificado" not in manzanas_localidad.columns:
-        manzanas_localidad["uso_pot_simplificado"] = "Sin clasificación POT"
-
-    bounds_m = manzanas_localidad.total_bounds
-    center_m = {
-        "lon": (bounds_m[0] + bounds_m[2]) / 2,
-        "lat": (bounds_m[1] + bounds_m[3]) / 2
+    # --- Gráficas opcionales: las desmarcadas no se exportan, no se codifican y su bloque no aparece en el informe ---
+    st.markdown("#### Gráficas incluidas en el informe")
+    columnas_graficas = st.columns(len(GRAFICAS_OPCIONALES))
+    graficas_incluidas = {
+        clave
+        for (clave, etiqueta), columna in zip(GRAFICAS_OPCIONALES.items(), columnas_graficas)
+        if columna.checkbox(etiqueta, value=True, key=f"incluir_{clave}")
     }
 
-    fig_manzanas = px.choropleth_mapbox(
-        manzanas_localidad,
-        geojson=manzanas_localidad.geometry,
-        locations=manzanas_localidad.index,
-        color="uso_pot_simplificado",
-        color_discrete_map=color_map,
-        mapbox_style="carto-positron",
-        center=center_m,
-        zoom=12,
-        opacity=0.5,
-        hover_name="id_manzana_unif"
-    )
+    # Formato de descarga: HTML autocontenido (imágenes incrustadas) o ZIP con el HTML y las imágenes aparte
+    informe_zip = st.checkbox("Descargar como ZIP (HTML + imágenes por separado)", key="informe_zip")
 
-    fig_manzanas.update_layout(
-        margin=dict(l=0, r=0, t=40, b=0),
-        title="Manzanas seleccionadas para el informe"
-    )
-#OJO BUFFER MANZANAS
-    buffer_manzanas = BytesIO()
-
-    pio.write_image(fig_manzanas, buffer_manzanas, format='png', engine='kaleido')
-    st.session_state.buffer_manzanas = buffer_manzanas
-    #st.session_state.buffer_localidad = buffer_localidad
-# Reemplazo de fig.write_image para compatibilidad con Streamlit Cloud
-    #st.plotly_chart(fig_final, use_container_width=True)
-    #st.session_state.buffer_manzanas = buffer_manzanas
-
-    # --- Generación del Informe ---
-    with st.spinner('📝 Generando informe...'):
-        import base64
-
-        manzana_id = st.session_state.manzana_sel
-        manzana_sel = st.session_state.manzanas_localidad_sel[
-            st.session_state.manzanas_localidad_sel["id_manzana_unif"] == manzana_id
-        ]
-
-        if manzana_sel.empty:
-            st.error("❌ No se encontró la información de la manzana seleccionada. Por favor vuelve y selecciona.")
-            if st.button("🔙 Volver al Análisis Comparativo"):
-                st.session_state.step = 5
-                st.rerun()
-        else:
-            estrato = int(manzana_sel["estrato"].values[0])
-            id_manzana = manzana_sel["id_manzana_unif"].values[0]
-            nombre_localidad = st.session_state.nombre_localidad
-            colegios = int(manzana_sel["colegio_cerca"].values[0])
-            estaciones = int(manzana_sel["estaciones_cerca"].values[0])
-
-            texto0 = (
-                f"El presente informe ha sido generado automáticamente como parte del trabajo final del Máster en Visual Analytics y Big Data "
-                f"de la Universidad Internacional de La Rioja. Este documento es el resultado del proyecto desarrollado por "
-                f"<strong>Sergio Andrés Fuentes Gómez</strong> y <strong>Miguel Alejandro González</strong>, bajo la dirección de "
-                f"<strong>Mariana Ríos Ortegón</strong>. Forma parte de un piloto experimental orientado a la aplicación práctica de técnicas "
-                f"de análisis visual y ciencia de datos en contextos urbanos reales."
-            )
-
-
-            texto1 = (
-                f"De acuerdo con su selección, la manzana identificada con el código <strong>{id_manzana}</strong>, "
-                f"ubicada en la localidad <strong>{nombre_localidad}</strong>, correspondiente al <strong>estrato {estrato}</strong>, "
-                f"presenta condiciones clave para evaluar su potencial de valorización en el contexto urbano de Bogotá."
-            )
-
-            texto2 = (
-                f"Cuenta con <strong>{colegios} colegios</strong> ubicados a menos de <strong>1.000 metros</strong> y "
-                f"<strong>{estaciones} estaciones de TransMilenio</strong> a menos de <strong>500 metros</strong>. "
-                f"Estos factores evidencian su buena conectividad y acceso a servicios."
-            )
-
-            id_area_manzana = manzana_sel["id_area"].values[0]
-            area_info = st.session_state.areas[st.session_state.areas["id_area"] == id_area_manzana]
-            area_pot = area_info["area_pot"].values[0]
-            uso_pot = area_info["uso_pot_simplificado"].values[0]
-
-            uso_pot_mayoritario = st.session_state.uso_pot_mayoritario
-            valor_area = f"${st.session_state.promedio_area:,.0f}"
-
-            texto3 = (
-                f"Desde el punto de vista normativo, la manzana se encuentra asignada al área denominada "
-                f"<strong>{area_pot}</strong> dentro del marco del <strong>Plan de Ordenamiento Territorial (POT)</strong>. "
-                f"Su uso principal es <strong>{uso_pot}</strong>. En un radio de 500 metros, el uso predominante es "
-                f"<strong>{uso_pot_mayoritario}</strong>. El valor promedio del metro cuadrado en el área POT es de "
-                f"<strong>{valor_area}</strong>."
-            )
-
-            valor_m2 = manzana_sel["valor_m2"].values[0]
-            rentabilidad = manzana_sel["rentabilidad"].values[0]
-            promedio_buffer = float(st.session_state.promedio_buffer)
-
-            texto4 = (
-                f"El valor actual del metro cuadrado es de <strong>${valor_m2:,.0f}</strong>. "
-                f"El promedio en un radio de 300 metros es de <strong>${promedio_buffer:,.0f}</strong>. "
-                f"El valor promedio en el área POT es <strong>{valor_area}</strong>. La rentabilidad estimada es de "
-                f"<strong>{rentabilidad}</strong>."
-            )
-
-            cod_loc = manzana_sel["num_localidad"].values[0]
-            info_seguridad = st.session_state.df_seguridad[st.session_state.df_seguridad["num_localidad"] == cod_loc].iloc[0]
-            nivel_riesgo = info_seguridad["nivel_riesgo_delictivo"]
-            delitos = int(info_seguridad["cantidad_delitos"])
-
-            texto5 = (
-                f"La localidad <strong>{nombre_localidad}</strong> presenta un nivel de riesgo <strong>{nivel_riesgo}</strong> "
-                f"con un total de <strong>{delitos} delitos</strong> reportados."
-            )
-
-            v_2025_1 = manzana_sel["valor_2025_s1"].values[0]
-            v_2025_2 = manzana_sel["valor_2025_s2"].values[0]
-            v_2026_1 = manzana_sel["valor_2026_s1"].values[0]
-            v_2026_2 = manzana_sel["valor_2026_s2"].values[0]
-
-            texto6 = (
-                f"Según las proyecciones, el valor del metro cuadrado podría ser:<br>"
-                f"- 2025-S1: <strong>${v_2025_1:,.0f}</strong><br>"
-                f"- 2025-S2: <strong>${v_2025_2:,.0f}</strong><br>"
-                f"- 2026-S1: <strong>${v_2026_1:,.0f}</strong><br>"
-                f"- 2026-S2: <strong>${v_2026_2:,.0f}</strong><br>"
-            )
-
-            def buffer_a_base64(buffer):
-                buffer.seek(0)
-                return base64.b64encode(buffer.read()).decode('utf-8')
-
-            img_colegios_base64 = buffer_a_base64(st.session_state.buffer_colegios)
-            img_transporte_base64 = buffer_a_base64(st.session_state.buffer_transporte)
-            img_distribucion_base64 = buffer_a_base64(st.session_state.buffer_dist_pot)
-            img_mapapot_base64 = buffer_a_base64(st.session_state.buffer_mapa_pot)
-            img_manzanas_base64 = buffer_a_base64(st.session_state.buffer_manzanas)
-            img_valorm2_base64 = buffer_a_base64(st.session_state.buffer_valorm2)
-            img_seguridad_base64 = buffer_a_base64(st.session_state.buffer_seguridad)
-            img_proyeccion_base64 = buffer_a_base64(st.session_state.buffer_proyeccion)
-            img_localidad_base64 = buffer_a_base64(st.session_state.buffer_localidad)
-
-            html_ficha = st.session_state.ficha_estilizada.to_html()
-
-
-            titulo = "Informe de Análisis de Inversión Inmobiliaria"
-
-            html_content = f"""
-            <!DOCTYPE html>
-            <html lang="es">
-            <head>
-                <meta charset="UTF-8">
-                <title>{titulo}</title>
-                <style>
-                    body {{ font-family: Arial, sans-serif; margin: 20px; background-color: #f9f9f9; }}
-                    h1 {{ color: #2c3e50; text-align: center; }}
-                    .container {{ display: flex; flex-direction: column; align-items: center; }}
-                    .text {{ text-align: justify; margin: 20px 0; max-width: 900px; font-size: 16px; color: #333; }}
-                    .images {{ display: flex; justify-content: center; gap: 20px; flex-wrap: wrap; max-width: 900px; margin: 0 auto; }}
-                    .image {{ flex: 1; max-width: 600px; }}
-                    .image img {{ width: 100%; height: auto; border: 1px solid #ccc; box-shadow: 2px 2px 8px rgba(0,0,0,0.1); }}
-                </style>
-            </head>
-            <body>
-                <div class="container">
-                    <h1>{titulo}</h1>
-                    <div class="text">{html_ficha}</div>
-                    <div class="text">{texto0}</div>
-                    <div class="images"><div class="image"><img src="data:image/png;base64,{img_localidad_base64}"></div></div>
-                    <div class="text">{texto1}</div>
-                    <div class="images"><div class="image"><img src="data:image/png;base64,{img_manzanas_base64}"></div></div>
-                    <div class="text">{texto2}</div>
-                    <div class="images">
-                        <div class="image"><img src="data:image/png;base64,{img_colegios_base64}"></div>
-                        <div class="image"><img src="data:image/png;base64,{img_transporte_base64}"></div>
-                    </div>
-                    <div class="text">{texto3}</div>
-                    <div class="images">
-
-                        <div class="image"><img src="data:image/png;base64,{img_mapapot_base64}"></div>
-                    </div>
-                    <div class="text">{texto4}</div>
-                    <div class="images"><div class="image"><img src="data:image/png;base64,{img_valorm2_base64}"></div></div>
-                    <div class="text">{texto5}</div>
-                    <div class="images"><div class="image"><img src="data:image/png;base64,{img_seguridad_base64}"></div></div>
-                    <div class="text">{texto6}</div>
-                    <div class="images"><div class="image"><img src="data:image/png;base64,{img_proyeccion_base64}"></div></div>
-                </div>
-            </body>
-            </html>
-            """
-
-            st.session_state.informe_html = html_content
-
-    st.success("✅ Informe generado correctamente.")
-
-    st.download_button(
-        "📥 Descargar Informe (HTML)",
-        data=st.session_state.informe_html,
-        file_name="Informe_Valorizacion.html",
-        mime="text/html"
-    )
+    # El informe se genera dentro de un contenedor creado antes de los botones de navegación: la página conserva
+    # el mismo orden, pero "Volver" y "Reiniciar" llegan al navegador antes de empezar el trabajo pesado y se
+    # pueden pulsar mientras se genera (el clic interrumpe este rerun y empieza el siguiente).
+    zona_informe = st.container()
 
     col1, col2 = st.columns(2)
     with col1:
-        if st.button("🔙 Volver al Análisis de Seguridad"):
-            st.session_state.step = 6
-            st.rerun()
+        st.button("🔙 Volver al Análisis de Seguridad", on_click=ir_a_paso, args=(6,))
     with col2:
-        if st.button("🔄 Reiniciar Aplicación"):
-            for key in list(st.session_state.keys()):
-                del st.session_state[key]
-            st.session_state.step = 1
-            st.rerun()
+        st.button("🔄 Reiniciar Aplicación", on_click=reiniciar_app)
+
+    with zona_informe:
+        # --- Generación del Informe ---
+        # El informe vive solo en este rerun: se entrega como bytes al botón de descarga y no se fija en session_state
+        informe_html = None
+        with st.spinner('📝 Generando informe...'):
+            manzana_id = st.session_state.manzana_sel
+            manzana_sel = buscar_manzana(st.session_state.manzanas_localidad_sel, manzana_id)
+
+            if manzana_sel.empty:
+                st.error("❌ No se encontró la información de la manzana seleccionada. Por favor vuelve y selecciona.")
+                st.button("🔙 Volver al Análisis Comparativo", on_click=ir_a_paso, args=(5,))
+            else:
+                estrato = int(manzana_sel["estrato"].iat[0])
+                id_manzana = manzana_sel["id_manzana_unif"].iat[0]
+                nombre_localidad = st.session_state.nombre_localidad
+                colegios = int(manzana_sel["colegio_cerca"].iat[0])
+                estaciones = int(manzana_sel["estaciones_cerca"].iat[0])
+
+                texto0 = (
+                    f"El presente informe ha sido generado automáticamente como parte del trabajo final del Máster en Visual Analytics y Big Data "
+                    f"de la Universidad Internacional de La Rioja. Este documento es el resultado del proyecto desarrollado por "
+                    f"<strong>Sergio Andrés Fuentes Gómez</strong> y <strong>Miguel Alejandro González</strong>, bajo la dirección de "
+                    f"<strong>Mariana Ríos Ortegón</strong>. Forma parte de un piloto experimental orientado a la aplicación práctica de técnicas "
+                    f"de análisis visual y ciencia de datos en contextos urbanos reales."
+                )
+
+
+                texto1 = (
+                    f"De acuerdo con su selección, la manzana identificada con el código <strong>{id_manzana}</strong>, "
+                    f"ubicada en la localidad <strong>{nombre_localidad}</strong>, correspondiente al <strong>estrato {estrato}</strong>, "
+                    f"presenta condiciones clave para evaluar su potencial de valorización en el contexto urbano de Bogotá."
+                )
+
+                texto2 = (
+                    f"Cuenta con <strong>{colegios} colegios</strong> ubicados a menos de <strong>1.000 metros</strong> y "
+                    f"<strong>{estaciones} estaciones de TransMilenio</strong> a menos de <strong>500 metros</strong>. "
+                    f"Estos factores evidencian su buena conectividad y acceso a servicios."
+                )
+
+                id_area_manzana = manzana_sel["id_area"].iat[0]
+                area_info = datos["areas"][datos["areas"]["id_area"] == id_area_manzana]
+                # Manzanas sin área POT (id_area nulo o inexistente en dim_area)
+                if area_info.empty:
+                    area_pot = "sin área asignada"
+                    uso_pot = "Sin clasificación POT"
+                else:
+                    area_pot = area_info["area_pot"].iat[0]
+                    uso_pot = area_info["uso_pot_simplificado"].iat[0]
+
+                uso_pot_mayoritario = st.session_state.uso_pot_mayoritario
+                valor_area = f"${st.session_state.promedio_area:,.0f}"
+
+                texto3 = (
+                    f"Desde el punto de vista normativo, la manzana se encuentra asignada al área denominada "
+                    f"<strong>{area_pot}</strong> dentro del marco del <strong>Plan de Ordenamiento Territorial (POT)</strong>. "
+                    f"Su uso principal es <strong>{uso_pot}</strong>. En un radio de 500 metros, el uso predominante es "
+                    f"<strong>{uso_pot_mayoritario}</strong>. El valor promedio del metro cuadrado en el área POT es de "
+                    f"<strong>{valor_area}</strong>."
+                )
+
+                valor_m2 = manzana_sel["valor_m2"].iat[0]
+                rentabilidad = manzana_sel["rentabilidad"].iat[0]
+                promedio_buffer = float(st.session_state.promedio_buffer)
+
+                texto4 = (
+                    f"El valor actual del metro cuadrado es de <strong>${valor_m2:,.0f}</strong>. "
+                    f"El promedio en un radio de 300 metros es de <strong>${promedio_buffer:,.0f}</strong>. "
+                    f"El valor promedio en el área POT es <strong>{valor_area}</strong>. La rentabilidad estimada es de "
+                    f"<strong>{rentabilidad}</strong>."
+                )
+
+                cod_loc = manzana_sel["num_localidad"].iat[0]
+                info_seguridad = st.session_state.df_seguridad[st.session_state.df_seguridad["num_localidad"] == cod_loc].iloc[0]
+                nivel_riesgo = info_seguridad["nivel_riesgo_delictivo"]
+                delitos = int(info_seguridad["cantidad_delitos"])
+
+                texto5 = (
+                    f"La localidad <strong>{nombre_localidad}</strong> presenta un nivel de riesgo <strong>{nivel_riesgo}</strong> "
+                    f"con un total de <strong>{delitos} delitos</strong> reportados."
+                )
+
+                v_2025_1 = manzana_sel["valor_2025_s1"].iat[0]
+                v_2025_2 = manzana_sel["valor_2025_s2"].iat[0]
+                v_2026_1 = manzana_sel["valor_2026_s1"].iat[0]
+                v_2026_2 = manzana_sel["valor_2026_s2"].iat[0]
+
+                texto6 = (
+                    f"Según las proyecciones, el valor del metro cuadrado podría ser:<br>"
+                    f"- 2025-S1: <strong>${v_2025_1:,.0f}</strong><br>"
+                    f"- 2025-S2: <strong>${v_2025_2:,.0f}</strong><br>"
+                    f"- 2026-S1: <strong>${v_2026_1:,.0f}</strong><br>"
+                    f"- 2026-S2: <strong>${v_2026_2:,.0f}</strong><br>"
+                )
+
+                # El mapa de manzanas se construye y exporta en caché por localidad (sin pasar por session_state)
+                st.session_state.buffer_manzanas = BytesIO(render_manzanas_png(
+                    cod_loc, st.session_state.manzanas_localidad_sel, datos["color_map"],
+                    datos["bounds_manzanas_por_localidad"][cod_loc]
+                ))
+
+                # Las figuras Plotly de los Bloques 5-6 se guardan como JSON y se rasterizan solo aquí, al generar el informe.
+                # Kaleido serializa las exportaciones en un único proceso, así que se exportan en secuencia.
+                for clave, formato in FIGURAS_INFORME.items():
+                    if clave in GRAFICAS_OPCIONALES and clave not in graficas_incluidas:
+                        continue
+                    if f"fig_{clave}" in st.session_state:
+                        st.session_state[f"buffer_{clave}"] = BytesIO(fig_a_imagen(st.session_state[f"fig_{clave}"], formato))
+
+                # Los mapas de matplotlib (localidad, colegios, transporte) son PNG; las figuras Plotly usan su formato.
+                # El mapa POT del informe es la misma imagen que la distribución de usos: se codifica una sola vez
+                imagenes = {
+                    clave: (st.session_state[f"buffer_{clave}"].getvalue(), TIPOS_MIME[FIGURAS_INFORME.get(clave, "png")])
+                    for clave in ("localidad", "manzanas", "colegios", "transporte", "dist_pot", "valorm2", "seguridad", "proyeccion")
+                    if (clave not in GRAFICAS_OPCIONALES or clave in graficas_incluidas)
+                    and f"buffer_{clave}" in st.session_state
+                }
+
+                textos = [texto0, texto1, texto2, texto3, texto4, texto5, texto6]
+                html_ficha = st.session_state.ficha_estilizada.to_html()
+                if informe_zip:
+                    informe_html = construir_informe_zip(textos, html_ficha, imagenes)
+                else:
+                    informe_html = construir_informe(textos, html_ficha, imagenes)
+
+        if informe_html is not None:
+            st.success("✅ Informe generado correctamente.")
+
+            if informe_zip:
+                st.download_button(
+                    "📥 Descargar Informe (ZIP)",
+                    data=informe_html,
+                    file_name="Informe_Valorizacion.zip",
+                    mime="application/zip"
+                )
+            else:
+                st.download_button(
+                    "📥 Descargar Informe (HTML)",
+                    data=informe_html,
+                    file_name="Informe_Valorizacion.html",
+                    mime="text/html"
+                )